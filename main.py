@@ -1,130 +1,547 @@
 import os
-import base64
-from fastapi import FastAPI, File, UploadFile, Request, HTTPException, Header, Form, Body
-from fastapi.responses import HTMLResponse
-from typing import Any, Dict, Optional, List
+import io
+import asyncio
+import hmac
+import httpx
+import orjson
+import pybase64
+import xxhash
+from fastapi import FastAPI, File, UploadFile, Request, HTTPException, Header, Body
+from fastapi.responses import HTMLResponse, JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, BinaryIO, Dict, Optional, List, Set, Tuple
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from openai import OpenAI
+from PIL import Image, ImageOps, UnidentifiedImageError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # Load environment variables
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
+openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
 access_token = os.getenv("ACCESS_TOKEN")
+# Opt-in: coalesce concurrent /analyze uploads into one multi-image call.
+# Off by default because text in one user's image can sway verdicts on the others.
+batch_max_size = int(os.getenv("BATCH_MAX_SIZE", "1"))
+batch_window_ms = float(os.getenv("BATCH_WINDOW_MS", "20"))
+# Larger uploads are refused before any image work is done
+max_upload_bytes = int(os.getenv("MAX_UPLOAD_MB", "15")) * 1024 * 1024
+# Upper bound on simultaneous OpenAI calls per worker
+openai_concurrency = int(os.getenv("OPENAI_CONCURRENCY", "8"))
 
 print(f"OPENAI_API_KEY: {openai_api_key}")
 print(f"ACCESS_TOKEN: {access_token}")
 
-# Initialize OpenAI client
-client = OpenAI(api_key=openai_api_key)
+# Requests go straight to the API over a connection pool created per worker at startup (see lifespan)
+http_client: Optional[httpx.AsyncClient] = None
+api_headers = {"Authorization": f"Bearer {openai_api_key}", "Content-Type": "application/json"}
+chat_completions_url = f"{openai_base_url}/chat/completions"
+api_semaphore = asyncio.Semaphore(openai_concurrency)
+# Image work pool, also created at startup (see lifespan)
+image_executor: Optional[ThreadPoolExecutor] = None
 
-app = FastAPI()
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib encoder."""
 
-def verify_access_token(token: Optional[str]):
-    """Check if the provided token matches the stored access token."""
-    if token != access_token:
-        raise HTTPException(status_code=401, detail="Invalid or missing access token")
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
-def call_gpt4_vision(base64_images: List[str]) -> Dict[str, Any]:
-    """
-    Calls GPT-4 Vision API with the given list of base64-encoded images.
-    Returns the API response.
-    """
-    prompt = (
-        'You are a professional analyzer that evaluates profile pictures for an App. '
-        'You are given images one by one. Answer either "true" or "false". '
-        'For false: provide a short reasoning advising the user on how to select a proper photo. '
-        'True: Profile picture should clearly contain a human face in front-facing view, standing or sitting, '
-        'wearing business or business casual attire, and free from offensive or NSFW content. '
-        'False: Detect and report any inappropriate images, such as offensive, manipulated, or AI-generated faces.'
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the OpenAI connection pool and image thread pool at startup and closes them on shutdown."""
+    global http_client, image_executor
+    # Without a key every call would go out as "Bearer None" and fail per request
+    if not openai_api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    # Pillow and pybase64 release the GIL, so image work scales across one thread per core
+    image_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+    # Shared HTTP/2 connection pool so calls reuse one TLS session
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
     )
 
-    messages = [
-        {
-            "role": "system",
-            "content": [{"type": "text", "text": prompt}]
-        }
-    ]
+    # Pay the TCP/TLS handshake now rather than on the first user request
+    try:
+        await http_client.get(f"{openai_base_url}/models", headers=api_headers)
+    except Exception as e:
+        print(f"OpenAI warm-up failed: {e}")
+
+    yield
+    await http_client.aclose()
+    image_executor.shutdown()
+    http_client = None
+    image_executor = None
 
-    # Append all images to the request
-    for base64_image in base64_images:
-        messages.append({
-            "role": "user",
-            "content": [
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
+app = FastAPI(default_response_class=OrjsonResponse, lifespan=lifespan)
+
+# Uploads are read and hashed in blocks that stay in L2 cache
+READ_BLOCK_SIZE = 256 * 1024
+# Leading bytes of the formats we accept; WEBP is checked separately (RIFF....WEBP)
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+
+# Verdicts for images seen recently; retries and re-submissions skip the model call
+VERDICT_CACHE_SIZE = 10_000
+VERDICT_CACHE_TTL = 3600
+verdict_cache: TTLCache = TTLCache(maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_TTL)
+
+# Uploads are downscaled to this long edge and re-encoded as JPEG before analysis
+MAX_IMAGE_EDGE = 1024
+JPEG_QUALITY = 85
+ORIENTATION_TAG = 0x0112
+# Images claiming more pixels than this are refused before being decoded
+MAX_IMAGE_PIXELS = 50_000_000
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+DATA_URL_PREFIX_BYTES = DATA_URL_PREFIX.encode("ascii")
+
+PROMPT = (
+    'You are a professional analyzer that evaluates profile pictures for an App. '
+    'You are given images one by one. Answer either "true" or "false". '
+    'For false: provide a short reasoning advising the user on how to select a proper photo. '
+    'True: Profile picture should clearly contain a human face in front-facing view, standing or sitting, '
+    'wearing business or business casual attire, and free from offensive or NSFW content. '
+    'False: Detect and report any inappropriate images, such as offensive, manipulated, or AI-generated faces.'
+)
+
+# Static parts of every request, serialized once below
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [{"type": "text", "text": PROMPT}]
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "content_compliance",
+        "schema": {
+            "type": "object",
+            "required": ["status", "violation_reason"],
+            "properties": {
+                "status": {
+                    "type": "boolean",
+                    "description": "Indicates whether the content is appropriate."
+                },
+                "violation_reason": {
+                    "type": "string",
+                    "description": "Explanation of why the content violates policies and suggestions for correction."
                 }
-            ],
-        })
+            },
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "content_compliance",
-                    "schema": {
-                        "type": "object",
-                        "required": ["status", "violation_reason"],
-                        "properties": {
-                            "status": {
-                                "type": "boolean",
-                                "description": "Indicates whether the content is appropriate."
-                            },
-                            "violation_reason": {
-                                "type": "string",
-                                "description": "Explanation of why the content violates policies and suggestions for correction."
-                            }
-                        },
-                        "additionalProperties": False
-                    },
-                    "strict": True
+BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [{
+        "type": "text",
+        "text": PROMPT + (
+            ' The images come from different users. Judge each image on its own and '
+            'return exactly one verdict per image, in the order the images were given.'
+        )
+    }]
+}
+
+BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "content_compliance_batch",
+        "schema": {
+            "type": "object",
+            "required": ["verdicts"],
+            "properties": {
+                "verdicts": {
+                    "type": "array",
+                    "items": RESPONSE_FORMAT["json_schema"]["schema"]
                 }
             },
-            temperature=0.5,
-            max_completion_tokens=1142,
-            top_p=0.79,
+            "additionalProperties": False
+        },
+        "strict": True
+    }
+}
+
+COMPLETION_PARAMS = {
+    "model": "gpt-4o-mini",
+    "temperature": 0.5,
+    "top_p": 0.79,
+}
+MAX_COMPLETION_TOKENS = 1142
+
+def build_request_prefix(system_message: Dict[str, Any], response_format: Dict[str, Any]) -> bytes:
+    """Serializes the fixed part of a request body, leaving the messages array open."""
+    body = orjson.dumps({**COMPLETION_PARAMS, "response_format": response_format, "messages": [system_message]})
+    # "messages" is serialized last; drop its closing "]}" so images can be appended
+    return body[:-2]
+
+# Pre-serialized request bodies; only image messages are spliced in per call
+REQUEST_PREFIX = build_request_prefix(SYSTEM_MESSAGE, RESPONSE_FORMAT)
+BATCH_REQUEST_PREFIX = build_request_prefix(BATCH_SYSTEM_MESSAGE, BATCH_RESPONSE_FORMAT)
+IMAGE_MESSAGE_OPEN = b',{"role":"user","content":[{"type":"image_url","image_url":{"url":'
+IMAGE_MESSAGE_CLOSE = b'}}]}'
+
+def is_valid_access_token(token: Optional[str]) -> bool:
+    """Compares the token with the stored access token in constant time."""
+    return hmac.compare_digest((token or "").encode("utf-8"), (access_token or "").encode("utf-8"))
+
+def require_started():
+    """Fails loudly when the app is served without running its lifespan."""
+    if http_client is None or image_executor is None:
+        raise RuntimeError(
+            "App was not started: run it with lifespan enabled "
+            "(not --lifespan off) or use TestClient as a context manager"
         )
-        return {"response": response.choices[0].message.content}
+
+def is_retryable(error: BaseException) -> bool:
+    """Connection problems, timeouts, rate limits and server errors are worth retrying."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+@retry(
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(is_retryable),
+    reraise=True,
+)
+async def send_completion(content: bytes) -> Dict[str, Any]:
+    """Posts a serialized chat completion request, retrying rate limits and server errors."""
+    # Only the request itself holds a slot, not the backoff between attempts
+    async with api_semaphore:
+        response = await http_client.post(chat_completions_url, content=content, headers=api_headers)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+async def create_completion(content: bytes) -> Dict[str, Any]:
+    """Sends a serialized chat completion request and returns the model's answer."""
+    try:
+        # Plain dict access; the SDK's model validation isn't needed for one field
+        data = await send_completion(content)
+        return {"response": data["choices"][0]["message"]["content"]}
+    except httpx.HTTPStatusError as e:
+        return {"error": f"Error code: {e.response.status_code} - {e.response.text}"}
     except Exception as e:
         return {"error": str(e)}
 
+def build_request(prefix: bytes, base64_images: List[str], max_completion_tokens: int) -> bytes:
+    """Completes a pre-serialized request body with one user message per image."""
+    parts = [prefix]
+    for base64_image in base64_images:
+        # orjson escapes client-supplied strings so they can't break out of the URL field
+        url = orjson.dumps(base64_image)
+        parts.append(IMAGE_MESSAGE_OPEN)
+        # Clients may already send a full data URL; otherwise splice the prefix in after the quote
+        if base64_image.startswith("data:"):
+            parts.append(url)
+        else:
+            parts += (b'"', DATA_URL_PREFIX_BYTES, memoryview(url)[1:])
+        parts.append(IMAGE_MESSAGE_CLOSE)
+    parts.append(b'],"max_completion_tokens":%d}' % max_completion_tokens)
+    return b"".join(parts)
+
+async def call_gpt4_vision(base64_images: List[str]) -> Dict[str, Any]:
+    """
+    Calls GPT-4 Vision API with the given list of base64-encoded images.
+    Returns the API response.
+    """
+    content = build_request(REQUEST_PREFIX, base64_images, MAX_COMPLETION_TOKENS)
+    return await create_completion(content)
+
+async def call_gpt4_vision_batch(base64_images: List[str]) -> List[Dict[str, Any]]:
+    """
+    Analyzes several unrelated images in one GPT-4 Vision call.
+    Returns one result per image, shaped like call_gpt4_vision's.
+    """
+    content = build_request(BATCH_REQUEST_PREFIX, base64_images, MAX_COMPLETION_TOKENS * len(base64_images))
+    result = await create_completion(content)
+    if "error" in result:
+        return [result] * len(base64_images)
+
+    try:
+        verdicts = orjson.loads(result["response"])["verdicts"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        verdicts = []
+
+    # A verdict list that doesn't line up can't be attributed; ask per image instead
+    if len(verdicts) != len(base64_images):
+        return list(await asyncio.gather(*(call_gpt4_vision([image]) for image in base64_images)))
+
+    return [{"response": orjson.dumps(verdict).decode("utf-8")} for verdict in verdicts]
+
+class VisionBatcher:
+    """
+    Coalesces concurrent single-image requests into multi-image GPT-4 Vision calls.
+    A batch is sent once max_size images are queued or window seconds have passed.
+    """
+
+    def __init__(self, max_size: int, window: float):
+        self.max_size = max_size
+        self.window = window
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, base64_image: str) -> Dict[str, Any]:
+        """Queues an image and waits for its verdict."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # First use on this event loop: start the collector
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.spawn(self.collect())
+
+        future = loop.create_future()
+        await self.queue.put((base64_image, future))
+        return await future
+
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def collect(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Send without blocking collection of the next batch
+            self.spawn(self.dispatch(batch))
+
+    async def dispatch(self, batch: List[Tuple[str, asyncio.Future]]):
+        images = [image for image, _ in batch]
+        try:
+            if len(images) == 1:
+                results = [await call_gpt4_vision(images)]
+            else:
+                results = await call_gpt4_vision_batch(images)
+        except Exception as e:
+            results = [{"error": str(e)}] * len(images)
+
+        for (_, future), result in zip(batch, results):
+            # The client may have disconnected and cancelled its future
+            if not future.done():
+                future.set_result(result)
+
+# Only set up when batching is enabled; otherwise uploads call the API directly
+batcher = VisionBatcher(batch_max_size, batch_window_ms / 1000) if batch_max_size > 1 else None
+
+def cache_key(*parts: bytes) -> bytes:
+    """Fingerprints the request images for the verdict cache."""
+    # Non-cryptographic is enough for a local cache and much faster than SHA-256
+    digest = xxhash.xxh3_128()
+    for part in parts:
+        # Length prefix keeps ["ab", "c"] and ["a", "bc"] apart
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.digest()
+
+def is_cacheable(result: Dict[str, Any]) -> bool:
+    """Only real verdicts are cached; errors and refusals (content None) are retried next time."""
+    response = result.get("response")
+    return isinstance(response, str) and bool(response)
+
+def is_supported_image(header: bytes) -> bool:
+    """Checks the file signature for JPEG, PNG, GIF or WEBP."""
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+def read_image_file(f: BinaryIO) -> Tuple[bytearray, bytes]:
+    """
+    Reads an uploaded image straight into a buffer of its exact size,
+    rejecting unknown formats and oversized files before the body is read.
+    Returns the buffer and its verdict cache key.
+    """
+    # SpooledTemporaryFile only gained readinto in Python 3.11; fall back to the file it wraps
+    if not hasattr(f, "readinto"):
+        f = f._file
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    if size > max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Uploaded file is too large")
+
+    buffer = bytearray(size)
+    with memoryview(buffer) as view:
+        offset = f.readinto(view[:16])
+        if not is_supported_image(bytes(view[:offset])):
+            raise HTTPException(status_code=415, detail="Only JPEG, PNG, GIF and WEBP images are supported")
+
+        # Hash each block right after reading it, while it is still in cache,
+        # instead of walking the whole image a second time; matches cache_key(buffer)
+        digest = xxhash.xxh3_128(size.to_bytes(8, "little"))
+        digest.update(view[:offset])
+        while offset < size:
+            read = f.readinto(view[offset:offset + READ_BLOCK_SIZE])
+            if not read:
+                break
+            digest.update(view[offset:offset + read])
+            offset += read
+    del buffer[offset:]
+    return buffer, digest.digest()
+
+async def read_upload(file: UploadFile) -> Tuple[bytearray, bytes]:
+    """Reads an uploaded image without copying it through an intermediate bytes object."""
+    # UploadSizeLimit already bounds the request; this also excludes the form fields
+    if file.size is not None and file.size > max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Uploaded file is too large")
+    # The spooled file may live on disk, so read it off the event loop
+    return await asyncio.to_thread(read_image_file, file.file)
+
+def to_data_url(image_bytes: bytes) -> str:
+    """Encodes JPEG bytes as a data URL."""
+    # Base64 is pure ASCII: join as bytes and decode once on the fast ASCII path
+    return (DATA_URL_PREFIX_BYTES + pybase64.b64encode(image_bytes)).decode("ascii")
+
+def prepare_image(image_bytes: bytes) -> str:
+    """
+    Downscales an uploaded image and returns it as a JPEG data URL.
+    Phone photos shrink from megabytes to a few hundred KB, which cuts encoding, upload and token cost.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if img.width * img.height > MAX_IMAGE_PIXELS:
+                raise HTTPException(status_code=400, detail="Uploaded image has too many pixels")
+
+            # Small upright JPEGs are already as cheap as they get
+            if (img.format == "JPEG" and max(img.size) <= MAX_IMAGE_EDGE
+                    and img.getexif().get(ORIENTATION_TAG, 1) == 1):
+                return to_data_url(image_bytes)
+
+            # Let JPEGs decode at a reduced scale instead of at full resolution
+            img.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+            # Re-encoding drops EXIF, so apply the orientation first
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+
+    return to_data_url(buffer.getvalue())
+
+class UploadSizeLimit:
+    """
+    ASGI middleware that caps /analyze request bodies at max_upload_bytes.
+    Requests declaring a larger Content-Length are refused before any of the body is read;
+    chunked requests are cut off as soon as the streamed body passes the limit.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/analyze":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_upload_bytes:
+            response = JSONResponse(status_code=413, content={"detail": "Uploaded file is too large"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_upload_bytes:
+                    # Raised while the form is being parsed; FastAPI passes HTTPExceptions through
+                    raise HTTPException(status_code=413, detail="Uploaded file is too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimit)
+
+@app.middleware("http")
+async def authenticate(request: Request, call_next):
+    """
+    Checks the x-access-token header on POST requests before the request body is read,
+    so unauthorized uploads are rejected without being received or parsed.
+    """
+    if request.method == "POST" and not is_valid_access_token(request.headers.get("x-access-token")):
+        return JSONResponse(status_code=401, content={"detail": "Invalid or missing access token"})
+    return await call_next(request)
+
+UPLOAD_FORM_HTML = """
+<!DOCTYPE html>
+<html>
+  <head>
+      <title>GPT-4 Vision Demo</title>
+  </head>
+  <body>
+      <h1>Upload an Image for GPT-4 Vision Analysis</h1>
+      <form id="upload-form">
+          <input type="file" name="file" accept="image/*" required />
+          <input type="text" name="x_access_token" placeholder="Enter Access Token" />
+          <button type="submit">Analyze Image</button>
+      </form>
+      <pre id="result"></pre>
+      <script>
+          // The token goes in the x-access-token header so the server can check it before reading the upload
+          document.getElementById("upload-form").addEventListener("submit", async (event) => {
+              event.preventDefault();
+              const form = event.target;
+              const body = new FormData();
+              body.append("file", form.file.files[0]);
+              const response = await fetch("/analyze", {
+                  method: "POST",
+                  headers: {"x-access-token": form.x_access_token.value},
+                  body,
+              });
+              document.getElementById("result").textContent = await response.text();
+          });
+      </script>
+  </body>
+</html>
+"""
+
+# The form never changes, so encode it and build the response once
+UPLOAD_FORM_RESPONSE = HTMLResponse(content=UPLOAD_FORM_HTML.encode("utf-8"), status_code=200)
+
 @app.get("/", response_class=HTMLResponse)
 def get_upload_form(request: Request):
     """Returns an HTML form for manual image upload."""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-      <head>
-          <title>GPT-4 Vision Demo</title>
-      </head>
-      <body>
-          <h1>Upload an Image for GPT-4 Vision Analysis</h1>
-          <form action="/analyze" method="post" enctype="multipart/form-data">
-              <input type="file" name="file" accept="image/*" />
-              <input type="text" name="x_access_token" placeholder="Enter Access Token" />
-              <button type="submit">Analyze Image</button>
-          </form>
-      </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content, status_code=200)
+    return UPLOAD_FORM_RESPONSE
 
 @app.post("/analyze")
-async def analyze_image(file: UploadFile = File(...), x_access_token: Optional[str] = Form(None)) -> Dict[str, Any]:
+async def analyze_image(
+    file: UploadFile = File(...),
+    x_access_token: Optional[str] = Header(None)
+) -> Dict[str, Any]:
     """Handles file upload and analysis via GPT-4 Vision."""
-    verify_access_token(x_access_token)
-    
-    # Read and encode image
-    image_bytes = await file.read()
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    # x_access_token has already been checked by the authenticate middleware
+    require_started()
 
-    # Call GPT-4 Vision API
-    return call_gpt4_vision([base64_image])
+    # Read, downscale and encode image off the event loop
+    image_bytes, key = await read_upload(file)
+    if key in verdict_cache:
+        return verdict_cache[key]
+
+    data_url = await asyncio.get_running_loop().run_in_executor(image_executor, prepare_image, image_bytes)
+
+    # Call GPT-4 Vision API, batched with other concurrent uploads when enabled
+    if batcher is not None:
+        result = await batcher.submit(data_url)
+    else:
+        result = await call_gpt4_vision([data_url])
+    if is_cacheable(result):
+        verdict_cache[key] = result
+    return result
 
 @app.post("/analyze-json")
 async def analyze_image_json(
@@ -138,17 +555,39 @@ async def analyze_image_json(
       "images_base64": ["<base64_string1>", "<base64_string2>"]
     }
     """
-    verify_access_token(x_access_token)
+    # x_access_token has already been checked by the authenticate middleware
+    require_started()
 
     # Extract base64 images
     base64_images = payload.get("images_base64", [])
     if not base64_images:
         raise HTTPException(status_code=400, detail="Missing images_base64 in request body")
+    # Base64 and data URLs are pure ASCII; anything else (e.g. lone surrogates) can't be hashed or serialized
+    if not isinstance(base64_images, list) or not all(
+        isinstance(image, str) and image.isascii() for image in base64_images
+    ):
+        raise HTTPException(status_code=400, detail="images_base64 must be a list of ASCII strings")
+
+    key = cache_key(*(image.encode("utf-8") for image in base64_images))
+    if key in verdict_cache:
+        return verdict_cache[key]
 
     # Call GPT-4 Vision API
-    return call_gpt4_vision(base64_images)
+    result = await call_gpt4_vision(base64_images)
+    if is_cacheable(result):
+        verdict_cache[key] = result
+    return result
 
 if __name__ == "__main__":
     # Run the FastAPI app with uvicorn
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" picks uvloop + httptools when installed and falls back to asyncio/h11
+    # (e.g. on Windows or PyPy); workers need an import string
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )